@@ -1,107 +1,434 @@
 import os
+import sys
+import hmac
+import random
+import logging
 import time
-import base64
-from io import BytesIO
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+from dataclasses import dataclass
+from itertools import takewhile
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from flask import Flask
-from requests_toolbelt.multipart.encoder import MultipartEncoder
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from flask import Flask, request
+from requests_toolbelt.multipart.encoder import MultipartEncoder, MultipartEncoderMonitor
 from dotenv import load_dotenv
 from uuid import uuid4
 
 # Umgebung laden
 load_dotenv()
 
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(message)s")
+logger = logging.getLogger("weclappocr")
+
 app = Flask(__name__)
 
 # Konfiguration
-CLIENT_ID = os.getenv('CLIENT_ID')
-TENANT_ID = os.getenv('TENANT_ID')
-CLIENT_SECRET = os.getenv('CLIENT_SECRET')
-WECLAPP_API_KEY = os.getenv('WECLAPP_API_KEY')
-WECLAPP_TENANT = os.getenv('WECLAPP_TENANT')
-USER_EMAIL = os.getenv('USER_EMAIL')
-FOLDER_NAME = os.getenv('FOLDER_NAME')
+ARCHIVE_FOLDER_NAME = 'Archiv'
+ATTACHMENT_WORKERS = 8
+GRAPH_BATCH_SIZE = 20
+# Nur Metadaten auflisten – Inhalt kommt roh über /$value statt base64-kodiert
+ATTACHMENT_SELECT = '$select=id,name,contentType'
+FILE_ATTACHMENT_TYPE = '#microsoft.graph.fileAttachment'
+PDF_CONTENT_TYPES = frozenset({'application/pdf', 'application/x-pdf'})
 GRAPH_API_ENDPOINT = 'https://graph.microsoft.com/v1.0'
-TOKEN_ENDPOINT = f'https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token'
+# Graph-Abo auf neue Mails: max. Laufzeit 4230 min, Verlängerung über /run
+SUBSCRIPTION_MINUTES = 4230
+SUBSCRIPTION_RENEW_MARGIN = 24 * 3600
+REQUIRED_ENV_VARS = ('CLIENT_ID', 'TENANT_ID', 'CLIENT_SECRET', 'WECLAPP_API_KEY', 'WECLAPP_TENANT', 'USER_EMAIL', 'FOLDER_NAME')
 
 
-def request_with_retries(method, url, headers=None, data=None, json_data=None, retries=3, timeout=10, log_entries=None):
-    for attempt in range(1, retries + 1):
-        try:
-            response = requests.request(method, url, headers=headers, data=data, json=json_data, timeout=timeout)
-            response.raise_for_status()
-            return response
-        except requests.RequestException as e:
-            if log_entries is not None:
-                log_entries.append(f"❗ Fehler bei Request {method} {url} (Versuch {attempt}): {e}")
-            if attempt == retries:
-                raise
-            time.sleep(5)
+@dataclass(frozen=True, slots=True)
+class Config:
+    client_id: str
+    client_secret: str
+    weclapp_api_key: str
+    user_email: str
+    folder_name: str
+    notification_url: str | None
+    client_state: str | None
+    token_endpoint: str
+    weclapp_base_url: str
+    weclapp_upload_url: str
+    folders_url: str
+    messages_url: str
+    messages_path: str
+    batch_url: str
+    subscriptions_url: str
+
+
+def load_config():
+    # Fehlende Pflichtwerte sofort melden statt URLs wie https://None.weclapp.com zu bauen
+    missing = [name for name in REQUIRED_ENV_VARS if not os.getenv(name)]
+    if missing:
+        raise RuntimeError(f"Fehlende Umgebungsvariablen: {', '.join(missing)}")
+    # Abgeleitete URLs einmalig beim Import vorberechnen
+    tenant_id = os.environ['TENANT_ID']
+    weclapp_tenant = os.environ['WECLAPP_TENANT']
+    user_email = os.environ['USER_EMAIL']
+    weclapp_base_url = f'https://{weclapp_tenant}.weclapp.com'
+    return Config(
+        client_id=os.environ['CLIENT_ID'],
+        client_secret=os.environ['CLIENT_SECRET'],
+        weclapp_api_key=os.environ['WECLAPP_API_KEY'],
+        user_email=user_email,
+        folder_name=os.environ['FOLDER_NAME'],
+        notification_url=os.getenv('NOTIFICATION_URL') or None,
+        client_state=os.getenv('CLIENT_STATE') or None,
+        token_endpoint=f'https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token',
+        weclapp_base_url=weclapp_base_url,
+        weclapp_upload_url=f'{weclapp_base_url}/webapp/api/v1/purchaseInvoice/startInvoiceDocumentProcessing/multipartUpload',
+        folders_url=f'{GRAPH_API_ENDPOINT}/users/{user_email}/mailFolders',
+        messages_url=f'{GRAPH_API_ENDPOINT}/users/{user_email}/messages',
+        messages_path=f'/users/{user_email}/messages',
+        batch_url=f'{GRAPH_API_ENDPOINT}/$batch',
+        subscriptions_url=f'{GRAPH_API_ENDPOINT}/subscriptions'
+    )
+
+
+CFG = load_config()
+
+
+class SessionRetry(Retry):
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        # POST nach Lesefehlern nicht wiederholen: der Server hat ihn evtl. schon ausgeführt (Moves, Abos)
+        if method == "POST" and error is not None and self.read is not False and self._is_read_error(error):
+            return self.new(read=False).increment(method, url, response, error, _pool, _stacktrace)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+    def get_backoff_time(self):
+        # 1 → 2 → 4 s (max. backoff_max) plus bis zu 1 s Zufall, damit Clients nicht gleichzeitig wiederholen
+        consecutive_errors = len(list(takewhile(lambda x: x.redirect_location is None, reversed(self.history))))
+        if consecutive_errors == 0:
+            return 0
+        return min(self.backoff_max, 2 ** (consecutive_errors - 1)) + random.uniform(0, 1)
+
+
+# Wiederholungen nur bei Drosselung/Gateway-Fehlern: nach 1–2, 2–3, 4–5 s (max. 30 s), Retry-After hat Vorrang
+RETRY_POLICY = SessionRetry(
+    total=3,
+    backoff_max=30,
+    status_forcelist=[429, 502, 503, 504],
+    allowed_methods=frozenset(["GET", "POST"]),
+    respect_retry_after_header=True
+)
+
+# Upload-Body (MultipartEncoder) lässt sich nicht zurückspulen – POST an weclapp nicht wiederholen
+UPLOAD_RETRY_POLICY = RETRY_POLICY.new(allowed_methods=frozenset(["GET"]))
+
+# Gemeinsame Session: Keep-Alive statt neuem TCP/TLS-Handshake pro Request
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(max_retries=RETRY_POLICY))
+SESSION.mount('https://graph.microsoft.com', HTTPAdapter(pool_connections=2, pool_maxsize=16, max_retries=RETRY_POLICY))
+SESSION.mount(CFG.weclapp_base_url, HTTPAdapter(pool_connections=2, pool_maxsize=16, max_retries=UPLOAD_RETRY_POLICY))
+
+# Access-Token bis kurz vor Ablauf wiederverwenden (/run kann parallel laufen)
+_TOKEN_CACHE = {"token": None, "exp": 0}
+_TOKEN_LOCK = threading.Lock()
+
+# Ordner-IDs sind je Postfach stabil – nur bei 404 neu ermitteln
+_FOLDER_ID_CACHE = {}
+
+# Aktives Graph-Abo für Benachrichtigungen über neue Mails
+_SUBSCRIPTION = {"id": None, "exp": 0}
+_SUBSCRIPTION_LOCK = threading.Lock()
+
+# Läufe über /run und Benachrichtigungen nacheinander verarbeiten (keine Doppel-Uploads)
+_RUN_LOCK = threading.Lock()
+
+# Prozessweiter Worker-Pool für Graph-Abrufe, kleiner als pool_maxsize der Adapter
+EXECUTOR = ThreadPoolExecutor(max_workers=ATTACHMENT_WORKERS, thread_name_prefix='graph')
+
+# Benachrichtigte Nachrichten sammeln und von einem einzigen Worker abarbeiten lassen
+_NOTIFIED_IDS = {}
+_NOTIFIED_LOCK = threading.Lock()
+NOTIFY_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='notify')
+
+
+def request_with_retries(method, url, headers=None, data=None, json_data=None, timeout=10, stream=False, log_entries=None):
+    # Wiederholungen übernimmt RETRY_POLICY im HTTPAdapter der Session
+    try:
+        response = SESSION.request(method, url, headers=headers, data=data, json=json_data, timeout=timeout, stream=stream)
+        if response.status_code == 401 and url.startswith(GRAPH_API_ENDPOINT):
+            # Token abgelaufen oder widerrufen: neu anmelden und mit dem aktuellen Token einmal wiederholen
+            rejected_authorization = response.request.headers.get('Authorization')
+            response.close()
+            invalidate_graph_token(rejected_authorization)
+            authenticate_graph(log_entries)
+            response = SESSION.request(method, url, headers=headers, data=data, json=json_data, timeout=timeout, stream=stream)
+        if not response.ok:
+            # Bei stream=True sonst bleibt die Verbindung belegt
+            response.close()
+        response.raise_for_status()
+        return response
+    except requests.RequestException as e:
+        if log_entries is not None:
+            log_entries.append(f"❗ Fehler bei Request {method} {url}: {e}")
+        raise
 
 
 def authenticate_graph(log_entries):
-    data = {
-        'client_id': CLIENT_ID,
-        'scope': 'https://graph.microsoft.com/.default',
-        'client_secret': CLIENT_SECRET,
-        'grant_type': 'client_credentials'
-    }
-    response = request_with_retries("POST", TOKEN_ENDPOINT, data=data, log_entries=log_entries)
-    return response.json()['access_token']
+    with _TOKEN_LOCK:
+        if _TOKEN_CACHE["token"] and time.time() < _TOKEN_CACHE["exp"] - 60:
+            return _TOKEN_CACHE["token"]
+        data = {
+            'client_id': CFG.client_id,
+            'scope': 'https://graph.microsoft.com/.default',
+            'client_secret': CFG.client_secret,
+            'grant_type': 'client_credentials'
+        }
+        # Session-Header nicht an den Token-Endpunkt mitsenden
+        response = request_with_retries("POST", CFG.token_endpoint, headers={'Authorization': None}, data=data, log_entries=log_entries)
+        token_data = response.json()
+        _TOKEN_CACHE["token"] = token_data['access_token']
+        _TOKEN_CACHE["exp"] = time.time() + int(token_data.get('expires_in', 0))
+        # Gilt für alle Graph-Aufrufe über die gemeinsame Session
+        SESSION.headers['Authorization'] = f'Bearer {_TOKEN_CACHE["token"]}'
+        return _TOKEN_CACHE["token"]
+
+
+def invalidate_graph_token(rejected_authorization):
+    with _TOKEN_LOCK:
+        # Nur verwerfen, wenn kein anderer Thread das Token inzwischen schon erneuert hat;
+        # der Session-Header bleibt bis zum Ersetzen durch authenticate_graph gesetzt
+        if _TOKEN_CACHE["token"] and rejected_authorization == f'Bearer {_TOKEN_CACHE["token"]}':
+            _TOKEN_CACHE["exp"] = 0
 
 
-def get_folder_id(access_token, folder_name, log_entries):
-    headers = {'Authorization': f'Bearer {access_token}'}
-    response = request_with_retries("GET", f'{GRAPH_API_ENDPOINT}/users/{USER_EMAIL}/mailFolders', headers=headers, log_entries=log_entries)
-    folders = response.json().get('value', [])
-    folder_id = next((f['id'] for f in folders if f['displayName'] == folder_name), None)
-    if not folder_id:
+def get_folder_id(folder_name, log_entries):
+    cache_key = (CFG.user_email, folder_name)
+    if cache_key in _FOLDER_ID_CACHE:
+        return _FOLDER_ID_CACHE[cache_key]
+    response = request_with_retries("GET", CFG.folders_url, log_entries=log_entries)
+    # Alle Ordner aus einer Abfrage merken – Quell- und Archivordner kosten so nur einen GET
+    folder_ids = {}
+    for folder in response.json().get('value', []):
+        folder_ids.setdefault(folder['displayName'], folder['id'])
+    for name, folder_id in folder_ids.items():
+        _FOLDER_ID_CACHE[(CFG.user_email, name)] = folder_id
+    if folder_name not in folder_ids:
         raise Exception(f"Ordner '{folder_name}' nicht gefunden.")
-    return folder_id
+    return folder_ids[folder_name]
 
 
-def fetch_emails(access_token, folder_id, log_entries):
-    headers = {'Authorization': f'Bearer {access_token}'}
-    response = request_with_retries("GET", f'{GRAPH_API_ENDPOINT}/users/{USER_EMAIL}/mailFolders/{folder_id}/messages', headers=headers, log_entries=log_entries)
+def invalidate_folder_id(folder_id):
+    for cache_key, cached_id in list(_FOLDER_ID_CACHE.items()):
+        if cached_id == folder_id:
+            _FOLDER_ID_CACHE.pop(cache_key, None)
+
+
+def is_not_found(error):
+    return isinstance(error, requests.HTTPError) and error.response is not None and error.response.status_code == 404
+
+
+def fetch_emails(folder_id, log_entries):
+    # Nur IDs von Mails mit Anhängen laden statt der kompletten Nachrichten
+    url = f'{CFG.folders_url}/{folder_id}/messages?$select=id,hasAttachments&$filter=hasAttachments eq true&$top=100'
+    try:
+        response = request_with_retries("GET", url, log_entries=log_entries)
+    except requests.HTTPError as e:
+        if is_not_found(e):
+            invalidate_folder_id(folder_id)
+        raise
     messages = response.json().get('value', [])
     return messages
 
 
-def archive_email(access_token, message_id, archive_folder_id, log_entries):
-    headers = {'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'}
-    move_url = f"{GRAPH_API_ENDPOINT}/users/{USER_EMAIL}/messages/{message_id}/move"
+def ensure_subscription(folder_id, log_entries):
+    if not (CFG.notification_url and CFG.client_state):
+        return
+    resource = f"users/{CFG.user_email}/mailFolders('{folder_id}')/messages"
+    # Abo-Status direkt loggen – log_entries werden ohne neue PDFs nicht ausgegeben
+    with _SUBSCRIPTION_LOCK:
+        try:
+            if not _SUBSCRIPTION["id"]:
+                adopt_subscription(resource, log_entries)
+            if _SUBSCRIPTION["id"] and time.time() < _SUBSCRIPTION["exp"] - SUBSCRIPTION_RENEW_MARGIN:
+                return
+            expiration = datetime.now(timezone.utc) + timedelta(minutes=SUBSCRIPTION_MINUTES)
+            expiration_date_time = expiration.strftime('%Y-%m-%dT%H:%M:%SZ')
+            if _SUBSCRIPTION["id"]:
+                try:
+                    data = {"expirationDateTime": expiration_date_time}
+                    request_with_retries("PATCH", f"{CFG.subscriptions_url}/{_SUBSCRIPTION['id']}", json_data=data, log_entries=log_entries)
+                    _SUBSCRIPTION["exp"] = expiration.timestamp()
+                    logger.info(f"🔔 Graph-Abo {_SUBSCRIPTION['id']} verlängert.")
+                    return
+                except requests.HTTPError as e:
+                    if not is_not_found(e):
+                        raise
+                    _SUBSCRIPTION["id"] = None
+            data = {
+                "changeType": "created",
+                "notificationUrl": CFG.notification_url,
+                "resource": resource,
+                "expirationDateTime": expiration_date_time,
+                "clientState": CFG.client_state
+            }
+            response = request_with_retries("POST", CFG.subscriptions_url, json_data=data, log_entries=log_entries)
+            _SUBSCRIPTION["id"] = response.json()['id']
+            _SUBSCRIPTION["exp"] = expiration.timestamp()
+            logger.info(f"🔔 Graph-Abo {_SUBSCRIPTION['id']} angelegt.")
+        except Exception as e:
+            logger.error(f"❌ Fehler beim Einrichten des Graph-Abos: {e}")
+
+
+def adopt_subscription(resource, log_entries):
+    # Nach einem Neustart vorhandene Abos dieser App übernehmen statt ein weiteres anzulegen
+    matches = []
+    url = CFG.subscriptions_url
+    while url:
+        page = request_with_retries("GET", url, log_entries=log_entries).json()
+        matches += [
+            sub for sub in page.get('value', [])
+            if sub.get('notificationUrl') == CFG.notification_url and (sub.get('resource') or '').lower() == resource.lower()
+        ]
+        url = page.get('@odata.nextLink')
+    if not matches:
+        return
+    # Ablaufzeit unbekannt – beim selben Lauf per PATCH verlängern
+    _SUBSCRIPTION["id"] = matches[0]['id']
+    _SUBSCRIPTION["exp"] = 0
+    for duplicate in matches[1:]:
+        try:
+            request_with_retries("DELETE", f"{CFG.subscriptions_url}/{duplicate['id']}", log_entries=log_entries)
+            logger.info(f"🔕 Doppeltes Graph-Abo {duplicate['id']} gelöscht.")
+        except requests.RequestException as e:
+            logger.warning(f"❌ Fehler beim Löschen des doppelten Graph-Abos {duplicate['id']}: {e}")
+
+
+def archive_email(message_id, archive_folder_id, log_entries):
+    move_url = f"{CFG.messages_url}/{message_id}/move"
     data = {"destinationId": archive_folder_id}
     try:
-        request_with_retries("POST", move_url, headers=headers, json_data=data, log_entries=log_entries)
+        try:
+            request_with_retries("POST", move_url, json_data=data, log_entries=log_entries)
+        except requests.HTTPError as e:
+            if not is_not_found(e):
+                raise
+            # Archivordner evtl. neu angelegt – ID einmalig neu ermitteln
+            invalidate_folder_id(archive_folder_id)
+            data = {"destinationId": get_folder_id(ARCHIVE_FOLDER_NAME, log_entries)}
+            request_with_retries("POST", move_url, json_data=data, log_entries=log_entries)
+        return True
     except Exception as e:
         log_entries.append(f"❌ Fehler beim Verschieben der Nachricht {message_id}: {e}")
+        return False
+
+
+def archive_emails(message_ids, archive_folder_id, log_entries):
+    for start in range(0, len(message_ids), GRAPH_BATCH_SIZE):
+        chunk = message_ids[start:start + GRAPH_BATCH_SIZE]
+        batch_requests = [
+            {
+                "id": str(i),
+                "method": "POST",
+                "url": f"{CFG.messages_path}/{message_id}/move",
+                "body": {"destinationId": archive_folder_id},
+                "headers": {"Content-Type": "application/json"}
+            }
+            for i, message_id in enumerate(chunk)
+        ]
+        try:
+            responses = graph_batch(batch_requests, log_entries)
+        except Exception:
+            responses = {}
+        for i, message_id in enumerate(chunk):
+            status = responses.get(str(i), {}).get('status', 0)
+            # Fehlgeschlagene Teil-Requests einzeln wiederholen
+            if 200 <= status < 300 or archive_email(message_id, archive_folder_id, log_entries):
+                log_entries.append(f"📥 E-Mail {message_id} archiviert.")
+
+
+def fetch_attachments(message_id, log_entries):
+    response = request_with_retries("GET", f"{CFG.messages_url}/{message_id}/attachments?{ATTACHMENT_SELECT}", log_entries=log_entries)
+    return response.json().get('value', [])
+
+
+def download_attachment(message_id, attachment_id, log_entries):
+    response = request_with_retries("GET", f"{CFG.messages_url}/{message_id}/attachments/{attachment_id}/$value", stream=True, log_entries=log_entries)
+    # PDFs direkt auf Platte statt im Speicher sammeln
+    pdf_file = tempfile.TemporaryFile()
+    try:
+        with response:
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                pdf_file.write(chunk)
+    except Exception:
+        pdf_file.close()
+        raise
+    pdf_file.seek(0)
+    return pdf_file
+
+
+def graph_batch(batch_requests, log_entries):
+    response = request_with_retries("POST", CFG.batch_url, json_data={"requests": batch_requests}, log_entries=log_entries)
+    return {r['id']: r for r in response.json().get('responses', [])}
+
+
+def fetch_attachments_batch(messages, log_entries):
+    batch_requests = [
+        {"id": str(i), "method": "GET", "url": f"{CFG.messages_path}/{msg['id']}/attachments?{ATTACHMENT_SELECT}"}
+        for i, msg in enumerate(messages)
+    ]
+    responses = graph_batch(batch_requests, log_entries)
+    results = []
+    for i, msg in enumerate(messages):
+        sub_response = responses.get(str(i), {})
+        status = sub_response.get('status', 0)
+        if 200 <= status < 300:
+            results.append(sub_response.get('body', {}).get('value', []))
+        elif status == 404:
+            log_entries.append(f"⚠️ Nachricht {msg['id']} nicht mehr vorhanden.")
+            results.append([])
+        else:
+            # z.B. 429 innerhalb des Batches – einzeln nachladen
+            results.append(fetch_attachments(msg['id'], log_entries))
+    return results
 
 
-def process_attachments(access_token, messages, archive_folder_id, log_entries):
-    headers = {'Authorization': f'Bearer {access_token}'}
+def process_attachments(messages, archive_folder_id, log_entries):
     pdf_attachments = {}
     message_ids_to_archive = []
+    messages = [msg for msg in messages if msg.get('hasAttachments') is not False]
 
-    for msg in messages:
-        response = request_with_retries("GET", f"{GRAPH_API_ENDPOINT}/users/{USER_EMAIL}/messages/{msg['id']}/attachments", headers=headers, log_entries=log_entries)
-        attachments = response.json().get('value', [])
+    # Anhänge in $batch-Requests à 20 Nachrichten parallel abrufen, Auswertung bleibt im Hauptthread
+    chunks = [messages[i:i + GRAPH_BATCH_SIZE] for i in range(0, len(messages), GRAPH_BATCH_SIZE)]
+    results = [attachments for batch in EXECUTOR.map(lambda chunk: fetch_attachments_batch(chunk, log_entries), chunks) for attachments in batch]
 
-        for attachment in attachments:
-            if attachment['@odata.type'] == '#microsoft.graph.fileAttachment' and attachment['contentType'].lower() == 'application/pdf':
-                pdf_bytes = base64.b64decode(attachment['contentBytes'])
-                filename = attachment['name']
-                if not filename.lower().endswith('.pdf'):
-                    filename += '.pdf'
-                pdf_attachments[str(uuid4())] = (filename, BytesIO(pdf_bytes), 'application/pdf')
-                log_entries.append(f"📄 Gefundene PDF: {filename}")
-                message_ids_to_archive.append(msg['id'])
+    pdfs = [
+        (msg['id'], attachment)
+        for msg, attachments in zip(messages, results)
+        for attachment in attachments
+        if attachment.get('@odata.type') == FILE_ATTACHMENT_TYPE and (attachment.get('contentType') or '').lower() in PDF_CONTENT_TYPES
+    ]
+    downloads = [EXECUTOR.submit(download_attachment, message_id, attachment['id'], log_entries) for message_id, attachment in pdfs]
 
-    if pdf_attachments:
-        upload_multiple_to_weclapp(pdf_attachments, log_entries)
-        for message_id in message_ids_to_archive:
-            archive_email(access_token, message_id, archive_folder_id, log_entries)
-            log_entries.append(f"📥 E-Mail {message_id} archiviert.")
-    return bool(pdf_attachments)
+    try:
+        for (message_id, attachment), download in zip(pdfs, downloads):
+            pdf_file = download.result()
+            filename = attachment['name']
+            if not filename.lower().endswith('.pdf'):
+                filename += '.pdf'
+            pdf_attachments[str(uuid4())] = (filename, pdf_file, 'application/pdf')
+            log_entries.append(f"📄 Gefundene PDF: {filename}")
+            message_ids_to_archive.append(message_id)
+
+        found_pdfs = bool(pdf_attachments)
+        if found_pdfs:
+            upload_multiple_to_weclapp(pdf_attachments, log_entries)
+    finally:
+        # Temporäre PDFs vor dem Archivieren schließen – auch wenn ein Download oder der Upload scheitert
+        for download in downloads:
+            if not download.cancel() and download.exception() is None:
+                download.result().close()
+        pdf_attachments.clear()
+
+    if found_pdfs:
+        archive_emails(list(dict.fromkeys(message_ids_to_archive)), archive_folder_id, log_entries)
+    return found_pdfs
 
 
 def upload_multiple_to_weclapp(pdf_attachments, log_entries):
@@ -110,42 +437,87 @@ def upload_multiple_to_weclapp(pdf_attachments, log_entries):
         filename: (filename, fileobj, mimetype)
         for _, (filename, fileobj, mimetype) in pdf_attachments.items()
     }
-    m = MultipartEncoder(fields=fields)
+    # Body wird beim Senden stückweise aus dem Encoder gelesen statt vorab zusammengesetzt
+    monitor = MultipartEncoderMonitor(MultipartEncoder(fields=fields))
     headers = {
-        'AuthenticationToken': WECLAPP_API_KEY,
+        # Graph-Token der Session nicht an weclapp weitergeben
+        'Authorization': None,
+        'AuthenticationToken': CFG.weclapp_api_key,
         'Accept': 'application/json',
-        'Content-Type': m.content_type
+        'Content-Type': monitor.content_type
     }
-    url = f"https://{WECLAPP_TENANT}.weclapp.com/webapp/api/v1/purchaseInvoice/startInvoiceDocumentProcessing/multipartUpload"
-    request_with_retries("POST", url, headers=headers, data=m, timeout=60, log_entries=log_entries)
+    request_with_retries("POST", CFG.weclapp_upload_url, headers=headers, data=monitor, timeout=60, log_entries=log_entries)
     uploaded_files = ', '.join(fields.keys())
     log_entries.append(f"✅ Upload erfolgreich: {uploaded_files}")
 
 
-def main():
+def main(message_ids=None):
     log_entries = []
-    try:
-        access_token = authenticate_graph(log_entries)
-        folder_id = get_folder_id(access_token, FOLDER_NAME, log_entries)
-        archive_folder_id = get_folder_id(access_token, 'Archiv', log_entries)
-        messages = fetch_emails(access_token, folder_id, log_entries)
-        if messages:
-            found_pdfs = process_attachments(access_token, messages, archive_folder_id, log_entries)
-            if found_pdfs:
-                print("✅ Verarbeitungslog:")
-                for entry in log_entries:
-                    print(entry, flush=True)
+    with _RUN_LOCK:
+        try:
+            authenticate_graph(log_entries)
+            folder_id = get_folder_id(CFG.folder_name, log_entries)
+            archive_folder_id = get_folder_id(ARCHIVE_FOLDER_NAME, log_entries)
+            if message_ids is None:
+                ensure_subscription(folder_id, log_entries)
+                messages = fetch_emails(folder_id, log_entries)
             else:
-                print("💊 Postfach durchsucht aber keine neuen Einkaufsrechnungen gefunden.", flush=True)
-        else:
-            print("💊 Postfach durchsucht aber keine neuen Einkaufsrechnungen gefunden.", flush=True)
-    except Exception as e:
-        log_entries.append(f"❗ Fehler im Hauptablauf: {e}")
-        print(f"❗ Fehler im Hauptablauf: {e}", flush=True)
-        if log_entries:
-            print("📝 Fehlerprotokoll:")
-            for entry in log_entries:
-                print(entry, flush=True)
+                # Aus Graph-Benachrichtigung: nur die gemeldeten Nachrichten verarbeiten
+                messages = [{'id': message_id} for message_id in dict.fromkeys(message_ids)]
+            if messages:
+                found_pdfs = process_attachments(messages, archive_folder_id, log_entries)
+                if found_pdfs:
+                    logger.info("✅ Verarbeitungslog:")
+                    for entry in log_entries:
+                        logger.info(entry)
+                else:
+                    logger.info("💊 Postfach durchsucht aber keine neuen Einkaufsrechnungen gefunden.")
+            else:
+                logger.info("💊 Postfach durchsucht aber keine neuen Einkaufsrechnungen gefunden.")
+        except Exception as e:
+            log_entries.append(f"❗ Fehler im Hauptablauf: {e}")
+            logger.error(f"❗ Fehler im Hauptablauf: {e}")
+            if log_entries:
+                logger.error("📝 Fehlerprotokoll:")
+                for entry in log_entries:
+                    logger.error(entry)
+
+
+def notified_message_ids(payload):
+    # Öffentlicher Endpunkt: fremde oder kaputte Payloads still verwerfen statt mit 500 abzubrechen
+    notifications = payload.get('value') if isinstance(payload, dict) else None
+    if not isinstance(notifications, list):
+        return []
+    expected_state = CFG.client_state.encode()
+    message_ids = []
+    for notification in notifications:
+        if not isinstance(notification, dict):
+            continue
+        client_state = notification.get('clientState')
+        resource_data = notification.get('resourceData')
+        if not (isinstance(client_state, str) and isinstance(resource_data, dict)):
+            continue
+        message_id = resource_data.get('id')
+        if isinstance(message_id, str) and message_id and hmac.compare_digest(client_state.encode(), expected_state):
+            message_ids.append(message_id)
+    return message_ids
+
+
+def queue_notified_messages(message_ids):
+    with _NOTIFIED_LOCK:
+        # Nur einplanen, wenn noch kein Lauf auf die wartenden IDs angesetzt ist
+        schedule = not _NOTIFIED_IDS
+        _NOTIFIED_IDS.update(dict.fromkeys(message_ids))
+    if schedule:
+        NOTIFY_EXECUTOR.submit(process_notified_messages)
+
+
+def process_notified_messages():
+    # Alle bis jetzt gemeldeten IDs in einem Lauf verarbeiten
+    with _NOTIFIED_LOCK:
+        message_ids = list(_NOTIFIED_IDS)
+        _NOTIFIED_IDS.clear()
+    main(message_ids)
 
 
 @app.route('/', methods=['GET'])
@@ -159,6 +531,21 @@ def run():
     return "✅ Script manuell ausgeführt", 200
 
 
+@app.route('/graph/notify', methods=['POST'])
+def graph_notify():
+    # Validierung beim Anlegen des Abos: Token unverändert als Klartext zurückgeben
+    validation_token = request.args.get('validationToken')
+    if validation_token:
+        return validation_token, 200, {'Content-Type': 'text/plain'}
+    if not CFG.client_state:
+        return "", 202
+    message_ids = notified_message_ids(request.get_json(silent=True))
+    if message_ids:
+        # Graph erwartet eine Antwort innerhalb von 3 Sekunden – Verarbeitung im Hintergrund
+        queue_notified_messages(message_ids)
+    return "", 202
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)